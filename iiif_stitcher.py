@@ -1,9 +1,21 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 from PIL import Image
+import numpy as np
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
 from io import BytesIO
-import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import namedtuple
 import os
 import json
+import shutil
+import time
+from functools import lru_cache
 from urllib.parse import urlparse, parse_qs
 
 # --- Configuration ---
@@ -11,8 +23,40 @@ from urllib.parse import urlparse, parse_qs
 TILE_SIZE = 1024
 DOWNLOAD_DIR = "iiif_tiles"
 BASE_IMAGE_RESOLVER_URL = "https://www.nb.no/services/image/resolver/"
+# JPEG quality used when re-encoding a stitched image
+JPEG_QUALITY = 92
+# Cached manifests younger than this (in seconds) are used without revalidation
+MANIFEST_CACHE_TTL = 24 * 60 * 60
+# Concurrent tile requests; also used as the session's connection pool size so
+# every worker can hold its own keep-alive connection to the same origin.
+MAX_WORKERS = 16
+# Maximum number of HEAD requests sent to warm the CDN when warm_cdn is enabled
+CDN_WARMUP_BURST = 16
 # --- End Configuration ---
 
+# Shared session so every request (manifest, info.json and tiles) reuses a pooled
+# keep-alive connection instead of paying a fresh TCP+TLS handshake.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Separate session for the fire-and-forget CDN warm-up HEAD requests. It never retries,
+# so a failing HEAD is dropped immediately instead of backing off.
+WARMUP_SESSION = requests.Session()
+WARMUP_SESSION.mount("https://", HTTPAdapter(pool_maxsize=CDN_WARMUP_BURST, max_retries=0))
+
+# Use libjpeg-turbo for tile decoding when PyTurboJPEG and its shared library are installed
+try:
+    TURBO_JPEG = TurboJPEG() if TurboJPEG is not None else None
+except (OSError, RuntimeError):
+    TURBO_JPEG = None
+
+# A single tile request: its grid position, pixel region and resolver URL
+TileJob = namedtuple('TileJob', ['row', 'col', 'x', 'y', 'width', 'height', 'url'])
+
 def get_params_from_url(url):
     """
     Extracts the Item ID and Page Number from the book's web URL.
@@ -34,89 +78,354 @@ def get_params_from_url(url):
         
     return item_id, page_number
 
-def get_iiif_details_from_manifest(item_id, page_label):
+def write_atomically(path, writer):
+    """
+    Creates path by calling writer with a temporary file opened for binary writing,
+    then moving it into place. An interrupted write never leaves a truncated file at
+    path (or a stray temporary file next to it).
+    """
+    tmp_path = path + ".part"
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_file_atomically(path, data):
+    """
+    Writes bytes to path using write_atomically.
+    """
+    write_atomically(path, lambda f: f.write(data))
+
+def read_cached_manifest(cache_path):
+    """
+    Returns the Manifest stored at cache_path, or None if it is missing or unreadable.
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def fetch_manifest(item_id, cache_dir=DOWNLOAD_DIR):
     """
-    Downloads the IIIF Manifest and finds the details for the specific page.
+    Returns the IIIF Manifest for an item, using a local copy in cache_dir when possible.
+    Stale copies are revalidated with the server using their ETag.
     """
+    cache_path = os.path.join(cache_dir, f"{item_id}.manifest.json")
+    etag_path = cache_path + ".etag"
+
+    # A corrupt cached copy is treated as missing, so it is neither used nor revalidated
+    cached_manifest = read_cached_manifest(cache_path)
+    if cached_manifest is not None and time.time() - os.path.getmtime(cache_path) < MANIFEST_CACHE_TTL:
+        print(f"Using cached Manifest: {cache_path}")
+        return cached_manifest
+
     manifest_url = f"https://api.nb.no/catalog/v1/iiif/{item_id}/manifest?profile=nbdigital"
     print(f"Fetching Manifest from: {manifest_url}")
 
-    response = requests.get(manifest_url, timeout=15)
+    headers = {}
+    if cached_manifest is not None and os.path.exists(etag_path):
+        with open(etag_path, 'r', encoding='utf-8') as f:
+            headers['If-None-Match'] = f.read().strip()
+
+    response = SESSION.get(manifest_url, headers=headers, timeout=15)
+
+    if response.status_code == 304 and cached_manifest is not None:
+        print("Manifest not modified, using cached copy.")
+        os.utime(cache_path)
+        return cached_manifest
+
     response.raise_for_status()
     manifest = response.json()
 
-    # Find the Canvas (page) that matches the requested page label
-    for canvas in manifest.get('sequences', [{}])[0].get('canvases', []):
-        if canvas.get('label') == page_label:
-            # Found the correct page canvas
-            
-            # Extract Image Service details
-            image_service = canvas.get('images', [{}])[0].get('resource', {}).get('service', {})
-            
-            iiif_id_url = image_service.get('@id')
-            if not iiif_id_url:
-                 raise KeyError("Could not find 'resource.service.@id' in the canvas object.")
-            
-            # The IIIF_IMAGE_ID is the last part of the service URL
-            iiif_image_id = iiif_id_url.split('/')[-1]
-
-            return {
-                'id': iiif_image_id,
-                'width': canvas['width'],
-                'height': canvas['height']
-            }
-            
-    raise ValueError(f"Page label '{page_label}' not found in the Manifest for item ID '{item_id}'.")
+    # Drop the old ETag before replacing the Manifest, so it can never end up
+    # paired with a different (or partially written) copy
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.exists(etag_path):
+        os.remove(etag_path)
+    write_file_atomically(cache_path, json.dumps(manifest).encode('utf-8'))
+    etag = response.headers.get('ETag')
+    if etag:
+        write_file_atomically(etag_path, etag.encode('utf-8'))
+
+    return manifest
+
+@lru_cache(maxsize=32)
+def load_manifest(item_id):
+    """
+    Loads the IIIF Manifest once and indexes its Canvases (pages) by label.
+    """
+    manifest = fetch_manifest(item_id)
+    canvases = manifest.get('sequences', [{}])[0].get('canvases', [])
+
+    # Iterate in reverse so the first Canvas wins if a label is repeated
+    return {canvas.get('label'): canvas for canvas in reversed(canvases)}
+
+def get_iiif_details_from_manifest(item_id, page_label):
+    """
+    Loads the IIIF Manifest and finds the details for the specific page.
+    """
+    canvas = load_manifest(item_id).get(page_label)
+    if canvas is None:
+        raise ValueError(f"Page label '{page_label}' not found in the Manifest for item ID '{item_id}'.")
+
+    # Extract Image Service details
+    image_service = canvas.get('images', [{}])[0].get('resource', {}).get('service', {})
+    
+    iiif_id_url = image_service.get('@id')
+    if not iiif_id_url:
+         raise KeyError("Could not find 'resource.service.@id' in the canvas object.")
+    
+    # The IIIF_IMAGE_ID is the last part of the service URL
+    iiif_image_id = iiif_id_url.split('/')[-1]
+
+    return {
+        'id': iiif_image_id,
+        'width': canvas['width'],
+        'height': canvas['height']
+    }
+
+
+def get_size_limits(info):
+    """
+    Returns the (maxWidth, maxHeight, maxArea) limits advertised by an IIIF info.json.
+    Missing limits are returned as None.
+    """
+    limits = dict(info)
+    # IIIF Image API 2.x puts the limits in the profile description object
+    profile = info.get('profile', [])
+    if isinstance(profile, list):
+        for entry in profile:
+            if isinstance(entry, dict):
+                limits.update(entry)
+    
+    max_width = limits.get('maxWidth')
+    max_height = limits.get('maxHeight', max_width)
+    return max_width, max_height, limits.get('maxArea')
+
+def full_size_allowed(info, width, height):
+    """
+    Checks whether an IIIF info.json permits requesting the image at its full size.
+    """
+    # A listed size covering the whole image is always servable, regardless of limits
+    for size in info.get('sizes', []):
+        if size.get('width', 0) >= width and size.get('height', 0) >= height:
+            return True
 
+    max_width, max_height, max_area = get_size_limits(info)
+    if (max_width is not None and width > max_width) or \
+       (max_height is not None and height > max_height) or \
+       (max_area is not None and width * height > max_area):
+        print(f"Full-size requests are capped at {max_width}x{max_height} (area {max_area}).")
+        return False
+    return True
 
-def download_and_stitch_iiif_image(image_id, width, height, tile_size, output_file, download_dir):
-    # ... (The stitching logic from the previous response remains here)
-    # The rest of the previous function is used here. 
-    # For brevity in this response, I'm omitting the exact copy of the stitching loop,
-    # but assume the function is identical to the one in the first answer.
+def download_full_image(image_id, width, height, output_file, session=SESSION):
+    """
+    Downloads the whole image in a single request, writing the server's JPEG as-is.
+    Returns False if the server does not allow full-size requests, so the caller
+    can fall back to stitching tiles.
+    """
+    info_url = f"{BASE_IMAGE_RESOLVER_URL}{image_id}/info.json"
+    print(f"\nProbing image service: {info_url}")
+    
+    # The probe is only an optimisation; if info.json is unavailable, stitch tiles instead
+    try:
+        response = session.get(info_url, timeout=10)
+        response.raise_for_status()
+        info = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Could not read image service info ({e}), falling back to tiles.")
+        return False
     
-    # NOTE: You must copy the full definition of this function from the previous 
-    # answer into your script to make it runnable.
+    if not full_size_allowed(info, width, height):
+        print("Falling back to tiles.")
+        return False
     
-    # Placeholder for the actual logic:
+    full_url = f"{BASE_IMAGE_RESOLVER_URL}{image_id}/full/full/0/default.jpg"
+    print(f"Downloading full image: {full_url}")
+    
+    with session.get(full_url, stream=True, timeout=60) as response:
+        if response.status_code in (414, 501):
+            print(f"Server rejected full-size request (HTTP {response.status_code}), falling back to tiles.")
+            return False
+        response.raise_for_status()
+        
+        # Stream the original bytes straight to disk; no decode or re-encode needed.
+        # Writing atomically keeps a failed transfer from leaving a truncated output file.
+        response.raw.decode_content = True
+        write_atomically(output_file, lambda f: shutil.copyfileobj(response.raw, f, length=1 << 20))
+    print(f"Success! Final image saved as: {output_file}")
+    return True
+
+
+def decode_tile(data):
+    """
+    Decodes the JPEG bytes of a tile into an RGB NumPy array.
+    """
+    if TURBO_JPEG is not None:
+        return TURBO_JPEG.decode(data, pixel_format=TJPF_RGB)
+    tile_img = Image.open(BytesIO(data))
+    # Ask libjpeg to decode straight to RGB, so no separate conversion pass is needed
+    tile_img.draft('RGB', tile_img.size)
+    tile_img.load()
+    if tile_img.mode != 'RGB':
+        # e.g. a greyscale tile, which draft() cannot expand to RGB
+        tile_img = tile_img.convert('RGB')
+    return np.asarray(tile_img)
+
+def fetch_tile(job, tile_filename=None, session=SESSION):
+    """
+    Downloads and decodes a single tile, optionally caching its bytes in tile_filename.
+    A tile already present in the cache is decoded from disk without any request; only
+    tiles that decode successfully are ever written to the cache.
+    Runs on a worker thread; both libjpeg and libjpeg-turbo release the GIL while decoding.
+    """
+    if tile_filename and os.path.exists(tile_filename):
+        try:
+            with open(tile_filename, 'rb') as f:
+                return decode_tile(f.read())
+        except (OSError, ValueError):
+            # An unreadable or corrupt cached tile is discarded and downloaded again
+            try:
+                os.remove(tile_filename)
+            except OSError:
+                pass
+
+    with session.get(job.url, stream=True, timeout=10) as response:
+        response.raise_for_status()
+        # Read the body in one piece rather than having requests join it from small chunks
+        data = response.raw.read(decode_content=True)
+
+    tile_arr = decode_tile(data)
+
+    if tile_filename:
+        try:
+            write_file_atomically(tile_filename, data)
+        except OSError:
+            # The cache is only an optimisation; keep the tile even if it cannot be stored
+            pass
+
+    return tile_arr
+
+def stitch_tile(canvas, job, tile_filename=None, session=SESSION):
+    """
+    Fetches a tile and copies it straight into its region of the canvas.
+    Tile regions never overlap, so worker threads can write to the canvas without a lock.
+    """
+    canvas[job.y:job.y + job.height, job.x:job.x + job.width] = fetch_tile(job, tile_filename, session)
+
+
+def warm_cdn_cache(jobs, session=WARMUP_SESSION):
+    """
+    Sends HEAD requests for the given tiles from background threads without waiting for
+    them, so the CDN can start caching those tiles before their GETs are issued.
+    """
+    if not jobs:
+        return
+    executor = ThreadPoolExecutor(max_workers=len(jobs))
+    for job in jobs:
+        executor.submit(session.head, job.url, timeout=5)
+    executor.shutdown(wait=False)
+
+
+def download_and_stitch_iiif_image(image_id, width, height, tile_size, output_file, download_dir, cache_tiles=False, session=SESSION, warm_cdn=False):
+    """
+    Downloads all tiles of the image concurrently and stitches them into a single image.
+    Tiles are kept in memory; set cache_tiles to also write each one to download_dir
+    and reuse tiles already stored there on later runs.
+    Set warm_cdn to send HEAD requests for tiles beyond the first wave of downloads,
+    so the CDN can cache them while the first wave is still in flight. These go through
+    the no-retry WARMUP_SESSION by default, or through session if a custom one is given,
+    so its proxies, headers and auth apply to them too.
+    """
     print(f"\nStitching will begin for ID: {image_id} ({width}x{height})")
     
     # Calculate the number of tiles in the grid
-    cols = math.ceil(width / tile_size)
-    rows = math.ceil(height / tile_size)
+    cols = (width + tile_size - 1) // tile_size
+    rows = (height + tile_size - 1) // tile_size
     
     print(f"Image dimensions: {width}x{height} pixels.")
     print(f"Tiling grid: {cols} columns x {rows} rows (total {cols*rows} tiles).")
     
-    stitched_image = Image.new('RGB', (width, height))
+    # Preallocated RGB pixel buffer; zeros keeps tiles that fail to download or decode black
+    canvas = np.zeros((height, width, 3), dtype=np.uint8)
+    
+    if cache_tiles:
+        os.makedirs(download_dir, exist_ok=True)
     
+    # Precompute every tile request up front. The parts of the URL and cache path that
+    # are the same for every tile are built once outside the loop.
+    url_prefix = BASE_IMAGE_RESOLVER_URL + image_id + '/'
+    cache_prefix = os.path.join(os.fspath(download_dir), image_id + '_')
+    jobs = []
     for row_idx in range(rows):
+        y_start = row_idx * tile_size
+        tile_h = min(tile_size, height - y_start)
         for col_idx in range(cols):
             x_start = col_idx * tile_size
-            y_start = row_idx * tile_size
             tile_w = min(tile_size, width - x_start)
-            tile_h = min(tile_size, height - y_start)
-            
-            region = f"{x_start},{y_start},{tile_w},{tile_h}"
-            size = f"{tile_w},"
-            
-            tile_url = f"{BASE_IMAGE_RESOLVER_URL}{image_id}/{region}/{size}/0/default.jpg"
-            
-            print(f"Downloading tile [{row_idx*cols + col_idx + 1}/{cols*rows}]: {region}")
             
+            region = '%d,%d,%d,%d' % (x_start, y_start, tile_w, tile_h)
+            tile_url = url_prefix + region + '/' + str(tile_w) + ',/0/default.jpg'
+            jobs.append(TileJob(row_idx, col_idx, x_start, y_start, tile_w, tile_h, tile_url))
+    
+    tile_filenames = [None] * len(jobs)
+    if cache_tiles:
+        tile_filenames = ['%s%d_%d_%d_%d.jpg' % (cache_prefix, job.x, job.y, job.width, job.height) for job in jobs]
+    
+    if warm_cdn:
+        # Tiles in the first wave are requested right away, so only the ones that will
+        # wait for a free worker benefit. Their HEADs run on separate threads alongside
+        # the first wave; tiles already in the tile cache are never requested at all.
+        to_download = [job for job, tile_filename in zip(jobs, tile_filenames)
+                       if not (tile_filename and os.path.exists(tile_filename))]
+        warmup_session = WARMUP_SESSION if session is SESSION else session
+        warm_cdn_cache(to_download[MAX_WORKERS:MAX_WORKERS + CDN_WARMUP_BURST], warmup_session)
+    
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for job, tile_filename in zip(jobs, tile_filenames):
+            futures[executor.submit(stitch_tile, canvas, job, tile_filename, session)] = job
+        
+        # Workers download, decode and copy each tile into the canvas themselves, so the
+        # main thread only reports progress and failures as tiles finish. Progress is a
+        # single line rewritten in place, written only from here rather than per worker.
+        for done, future in enumerate(as_completed(futures), start=1):
+            job = futures.pop(future)
             try:
-                response = requests.get(tile_url, timeout=10)
-                response.raise_for_status() 
-
-                tile_img = Image.open(BytesIO(response.content))
-                stitched_image.paste(tile_img, (x_start, y_start))
+                future.result()
                 
-            except requests.exceptions.RequestException as e:
-                print(f"Error downloading {tile_url}: {e}")
-                continue
+            except (requests.exceptions.RequestException, Urllib3HTTPError) as e:
+                print(f"\nError downloading {job.url}: {e}")
+            except (OSError, ValueError) as e:
+                # Undecodable body, or a tile whose size does not match its region;
+                # like a failed download, it is left black rather than aborting the page
+                print(f"\nError decoding {job.url}: {e}")
+            
+            print(f"\rDownloaded tiles: {done}/{len(jobs)}", end='', flush=True)
     
     print("\nStitching complete. Saving final image...")
-    stitched_image.save(output_file)
+    # Pillow copies RGB arrays into its own 4-bytes-per-pixel storage, so release the
+    # canvas before encoding rather than holding both full-size buffers at once.
+    stitched_image = Image.fromarray(canvas)
+    del canvas
+    
+    # Baseline, non-optimized JPEG lets libjpeg stream the output through a small
+    # fixed buffer. optimize=True or progressive=True make Pillow size its output
+    # buffer to the whole image (and optimize adds a second Huffman pass).
+    stitched_image.save(
+        output_file,
+        format='JPEG',
+        quality=JPEG_QUALITY,
+        optimize=False,
+        progressive=False,
+        subsampling=2
+    )
     print(f"Success! Final image saved as: {output_file}")
 
 
@@ -137,15 +446,16 @@ if __name__ == '__main__':
         print(f"Resolved IIIF Image ID: {IIIF_IMAGE_ID}")
         print(f"Resolved Dimensions: {FULL_WIDTH}x{FULL_HEIGHT}")
         
-        download_and_stitch_iiif_image(
-            IIIF_IMAGE_ID,
-            FULL_WIDTH,
-            FULL_HEIGHT,
-            TILE_SIZE,
-            OUTPUT_FILENAME,
-            DOWNLOAD_DIR
-        )
-
-    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        if not download_full_image(IIIF_IMAGE_ID, FULL_WIDTH, FULL_HEIGHT, OUTPUT_FILENAME):
+            download_and_stitch_iiif_image(
+                IIIF_IMAGE_ID,
+                FULL_WIDTH,
+                FULL_HEIGHT,
+                TILE_SIZE,
+                OUTPUT_FILENAME,
+                DOWNLOAD_DIR
+            )
+
+    except (requests.exceptions.RequestException, Urllib3HTTPError, ValueError, KeyError) as e:
         print(f"\n--- FATAL ERROR ---")
         print(f"Could not process URL: {e}")